@@ -1,27 +1,133 @@
+import math
+import threading
+import itertools
 import insightface
+from insightface.app.common import Face
 import roop.globals
+from roop.sessions import get_session_pool
+from roop.app import SCRFD_Child, TILE_OVERLAP
 
 FACE_ANALYSER = None
+THREAD_LOCK = threading.Lock()
+DET_SIZES = (160, 256, 320, 480, 640)
+# faces smaller than this in the detector input start to get missed
+MIN_DET_FACE_SIZE = 32
+# leave room for faces half the size of the smallest one seen so far
+EXPECTED_FACE_MARGIN = 0.5
+# run a full size detection every so often so new, smaller faces are not missed forever
+DET_REFRESH_INTERVAL = 30
+# only frames with a longer side than this are worth tiling
+TILED_MIN_RESOLUTION = 2560
+# relative face size to expect in a crowd before any face has been seen
+CROWD_FACE_SIZE = 0.02
+# with a quarter overlap every face either fits in an overlap or is large enough for the whole frame pass
+MAX_TILES_PER_SIDE = 4
 
 
 def get_face_analyser():
     global FACE_ANALYSER
-    if FACE_ANALYSER is None:
-        FACE_ANALYSER = insightface.app.FaceAnalysis(name='buffalo_l', providers=roop.globals.providers)
-        FACE_ANALYSER.prepare(ctx_id=0, det_size=(640, 640))
+    with THREAD_LOCK:
+        if FACE_ANALYSER is None:
+            # the swap only needs the keypoints and the identity, skip the landmark and attribute models
+            FACE_ANALYSER = insightface.app.FaceAnalysis(name='buffalo_l', allowed_modules=['detection', 'recognition'], providers=roop.globals.providers)
+            # insightface does not forward session options, run on pooled sessions built with ours
+            for model in FACE_ANALYSER.models.values():
+                model.session = get_session_pool(model.model_file)
+            # our detector runs on bound buffers and the vectorised nms
+            det_model = FACE_ANALYSER.det_model
+            FACE_ANALYSER.det_model = FACE_ANALYSER.models['detection'] = SCRFD_Child(det_model.model_file, det_model.session)
+            FACE_ANALYSER.prepare(ctx_id=0, det_size=(640, 640))
     return FACE_ANALYSER
 
 
-def get_face_single(img_data):
-    face = get_face_analyser().get(img_data)
+def clear_face_analyser():
+    global FACE_ANALYSER
+    with THREAD_LOCK:
+        FACE_ANALYSER = None
+
+
+def has_face(img_data, state):
+    # a detector pass alone is much cheaper than the full analyser, at a size that still finds
+    # the smallest faces seen so far and at full size before any face was seen
+    bboxes, _ = get_face_analyser().det_model.detect(img_data, input_size=state.get_fitted_size())
+    return bboxes.shape[0] > 0
+
+
+class DetectionState:
+    # the faces seen so far in one stream of target frames, every run, live session and server job
+    # keeps its own so the faces of one do not steer the detector of another
+    def __init__(self):
+        self.smallest_face = None
+        self.detections = itertools.count()
+
+    def get_det_size(self):
+        if next(self.detections) % DET_REFRESH_INTERVAL == 0:
+            return DET_SIZES[-1], DET_SIZES[-1]
+        return self.get_fitted_size()
+
+    def get_fitted_size(self):
+        if self.smallest_face is None:
+            return DET_SIZES[-1], DET_SIZES[-1]
+        # pick the smallest detector input that still keeps the expected faces detectable,
+        # the face size is relative to the frame so the frame resolution drops out
+        required_size = MIN_DET_FACE_SIZE / (self.smallest_face * EXPECTED_FACE_MARGIN)
+        det_size = next((size for size in DET_SIZES if size >= required_size), DET_SIZES[-1])
+        return det_size, det_size
+
+    def get_tile_size(self, img_shape):
+        frame_size = max(img_shape[:2])
+        if not roop.globals.tiled_detection or frame_size < TILED_MIN_RESOLUTION:
+            return None
+        expected_face = self.smallest_face if self.smallest_face is not None else CROWD_FACE_SIZE
+        # tiles just small enough that the expected faces reach the detectable size in the detector input
+        tile_size = int(expected_face * EXPECTED_FACE_MARGIN * frame_size * DET_SIZES[-1] / MIN_DET_FACE_SIZE)
+        if tile_size >= frame_size:
+            return None
+        # the smallest tile that still covers the frame in MAX_TILES_PER_SIDE overlapping tiles
+        min_tile_size = math.ceil(frame_size / (MAX_TILES_PER_SIDE - (MAX_TILES_PER_SIDE - 1) * TILE_OVERLAP))
+        return max(tile_size, DET_SIZES[-1], min_tile_size)
+
+    def update(self, bboxes, img_shape):
+        if bboxes.shape[0] > 0:
+            # relative to the frame, so frames of any resolution compare
+            face_size = min(bboxes[:, 3] - bboxes[:, 1]) / max(img_shape[:2])
+            self.smallest_face = face_size if self.smallest_face is None else min(self.smallest_face, face_size)
+
+
+# only target frames, which come with the detection state of their stream, adapt the detector to the
+# faces seen so far, source and reference images always get the full size pass
+def get_faces(img_data, recognition=True, state=None):
+    face_analyser = get_face_analyser()
+    # the detector resizes once to its input size and returns full resolution boxes and keypoints
+    tile_size = state.get_tile_size(img_data.shape) if state else None
+    if tile_size:
+        bboxes, kpss = face_analyser.det_model.detect_tiled(img_data, tile_size, input_size=(DET_SIZES[-1], DET_SIZES[-1]))
+    elif state:
+        bboxes, kpss = face_analyser.det_model.detect(img_data, input_size=state.get_det_size())
+    else:
+        bboxes, kpss = face_analyser.det_model.detect(img_data, input_size=(DET_SIZES[-1], DET_SIZES[-1]))
+    if state:
+        state.update(bboxes, img_data.shape)
+    faces = []
+    for bbox, kps in zip(bboxes, kpss):
+        face = Face(bbox=bbox[0:4], kps=kps, det_score=bbox[4])
+        if recognition:
+            face_analyser.models['recognition'].get(img_data, face)
+        faces.append(face)
+    return faces
+
+
+def get_face_single(img_data, state=None):
+    # the single face swap only needs the keypoints of a target face, not its identity
+    face = get_faces(img_data, recognition=state is None, state=state)
     try:
         return sorted(face, key=lambda x: x.bbox[0])[0]
     except IndexError:
         return None
 
 
-def get_face_many(img_data):
+def get_face_many(img_data, recognition=True, state=None):
     try:
-        return get_face_analyser().get(img_data)
+        return get_faces(img_data, recognition, state)
     except IndexError:
         return None
@@ -1,27 +1,179 @@
+import threading
 import numpy
 import cv2
 from insightface.utils import face_align
 from insightface.model_zoo import SCRFD, ArcFaceONNX
+from insightface.model_zoo.scrfd import distance2bbox, distance2kps
+from insightface.model_zoo.inswapper import INSwapper
+
+# neighbouring tiles share a quarter of their size, faces up to that size are whole in one of them
+TILE_OVERLAP = 0.25
+# boxes this close to an inner tile edge, in detector pixels, are faces cut in half
+TILE_EDGE_MARGIN = 2
+
+def nms(dets, thresh):
+    order = dets[:, 4].argsort()[::-1]
+    rank = numpy.empty(order.shape[0], dtype=numpy.intp)
+    rank[order] = numpy.arange(order.shape[0])
+    # only boxes whose horizontal ranges intersect can overlap, sweeping over the boxes sorted by x1
+    # finds those pairs without building the full pairwise matrix, which explodes on crowded frames.
+    by_x1 = dets[:, 0].argsort(kind='stable')
+    x1, y1, x2, y2 = dets[by_x1, :4].T
+    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+    starts = numpy.arange(1, order.shape[0] + 1)
+    counts = numpy.maximum(numpy.searchsorted(x1, x2 + 1) - starts, 0)
+    offsets = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    first = numpy.repeat(starts - 1, counts)
+    second = numpy.repeat(starts, counts) + offsets
+    # the second box of a pair never starts left of the first one.
+    w = numpy.minimum(x2[first], x2[second]) - x1[second] + 1
+    h = numpy.minimum(y2[first], y2[second]) - numpy.maximum(y1[first], y1[second]) + 1
+    intersecting = (w > 0) & (h > 0)
+    first, second, inter = first[intersecting], second[intersecting], w[intersecting] * h[intersecting]
+    overlapping = inter / (areas[first] + areas[second] - inter) > thresh
+    first_rank = rank[by_x1[first[overlapping]]]
+    second_rank = rank[by_x1[second[overlapping]]]
+    higher = numpy.minimum(first_rank, second_rank)
+    lower = numpy.maximum(first_rank, second_rank)
+    # greedy nms is the fixed point of 'keep a box unless a kept higher scoring box overlaps it',
+    # every iteration settles at least one more box in score order so this converges in a few steps.
+    keep = numpy.ones(order.shape[0], dtype=bool)
+    while True:
+        new_keep = numpy.ones(order.shape[0], dtype=bool)
+        new_keep[lower[keep[higher]]] = False
+        if numpy.array_equal(new_keep, keep):
+            return order[keep]
+        keep = new_keep
+
+
+def get_tile_starts(length, tile_size, overlap):
+    if length <= tile_size:
+        return [0]
+    return list(range(0, length - tile_size, tile_size - overlap)) + [length - tile_size]
+
+
+def rank_detections(det, img_shape, metric):
+    # caculate the area of candidate boxes.
+    area = (det[:, 2] - det[:, 0]) * (det[:, 3] - det[:, 1])
+    # caculate the offsets of candidate box from the center of image.
+    img_center = img_shape[0] // 2, img_shape[1] // 2
+    offsets = numpy.vstack([
+        (det[:, 0] + det[:, 2]) / 2 - img_center[1],
+        (det[:, 1] + det[:, 3]) / 2 - img_center[0]
+    ])
+    offset_dist_squared = numpy.sum(numpy.power(offsets, 2.0), 0)
+    # according to different mertrics, caculate the priority value of candidate boxes 
+    if metric=='max':
+        values = area
+    else:
+        values = area - offset_dist_squared * 2.0  # some extra weight on the centering
+    # sort the candidate boxes in desending order based on their priority values
+    return numpy.argsort(values)[::-1]
+
+
+def fill_blob(blob, img, input_mean, input_std):
+    # what cv2.dnn.blobFromImage with swapRB does, written plane by plane into a bound input
+    for channel in range(3):
+        numpy.subtract(img[:, :, 2 - channel], numpy.float32(input_mean), out=blob[0, channel], casting='unsafe')
+    blob *= numpy.float32(1.0 / input_std)
+
 
 class SCRFD_Child(SCRFD):
-    def filter_max_num(self, det, kpss, img_shape, max_num, metric):
-        # caculate the area of candidate boxes.
-        area = (det[:, 2] - det[:, 0]) * (det[:, 3] - det[:, 1])
-        # caculate the offsets of candidate box from the center of image.
-        img_center = img_shape[0] // 2, img_shape[1] // 2
-        offsets = numpy.vstack([
-            (det[:, 0] + det[:, 2]) / 2 - img_center[1],
-            (det[:, 1] + det[:, 3]) / 2 - img_center[0]
-        ])
-        offset_dist_squared = numpy.sum(numpy.power(offsets, 2.0), 0)
-        # according to different mertrics, caculate the priority value of candidate boxes 
-        if metric=='max':
-            values = area
+    def __init__(self, model_file=None, session=None):
+        super().__init__(model_file, session)
+        self.local = threading.local()
+        # only a batched model with a free batch dimension takes several tiles in one run
+        self.dynamic_batch = self.batched and not isinstance(self.session.get_inputs()[0].shape[0], int)
+
+    def nms(self, dets):
+        return nms(dets, self.nms_thresh)
+
+    # reuse the padded detector input for every size instead of allocating it on every call,
+    # every thread gets its own buffers.
+    def get_det_img(self, img, input_size, new_width, new_height):
+        det_buffers = self.local.__dict__.setdefault('det_buffers', {})
+        key = (input_size, new_width, new_height)
+        if key in det_buffers:
+            det_img, resized_img = det_buffers[key]
         else:
-            values = area - offset_dist_squared * 2.0  # some extra weight on the centering
-        # sort the candidate boxes in desending order based on their priority values and keep the top 'max_num' boxes.
-        top_index = numpy.argsort(values)[::-1]
-        top_index = top_index[0:max_num]
+            det_img = numpy.zeros((input_size[1], input_size[0], 3), dtype=numpy.uint8)
+            resized_img = numpy.empty((new_height, new_width, 3), dtype=numpy.uint8)
+            if len(det_buffers) < 100:
+                det_buffers[key] = det_img, resized_img
+        cv2.resize(img, (new_width, new_height), dst=resized_img)
+        det_img[:new_height, :new_width, :] = resized_img
+        return det_img
+
+    # same as SCRFD.forward but the blob is prepared in the bound input buffer of a pooled session
+    def forward(self, img, threshold):
+        input_height, input_width = img.shape[0:2]
+        with self.session.checkout() as session:
+            blob = session.get_input_buffers({self.input_name: (1, 3, input_height, input_width)})[self.input_name]
+            fill_blob(blob, img, self.input_mean, self.input_std)
+            net_outs = session.run(self.output_names, {self.input_name: blob})
+            # the outputs live in the buffers of the replica, decode them before handing it back
+            return self.decode(net_outs, input_height, input_width, threshold)
+
+    # runs (crop, scale) tiles through the detector, all in one batch when the model allows it
+    def forward_tiles(self, tiles, input_size, threshold):
+        input_width, input_height = input_size
+        with self.session.checkout() as session:
+            if not self.dynamic_batch:
+                results = []
+                blob = session.get_input_buffers({self.input_name: (1, 3, input_height, input_width)})[self.input_name]
+                for crop, scale in tiles:
+                    fill_blob(blob, self.get_det_img(crop, input_size, int(crop.shape[1] * scale), int(crop.shape[0] * scale)), self.input_mean, self.input_std)
+                    net_outs = session.run(self.output_names, {self.input_name: blob})
+                    results.append(self.decode(net_outs, input_height, input_width, threshold))
+                return results
+            blob = session.get_input_buffers({self.input_name: (len(tiles), 3, input_height, input_width)})[self.input_name]
+            for index, (crop, scale) in enumerate(tiles):
+                fill_blob(blob[index:index + 1], self.get_det_img(crop, input_size, int(crop.shape[1] * scale), int(crop.shape[0] * scale)), self.input_mean, self.input_std)
+            net_outs = session.run(self.output_names, {self.input_name: blob})
+            return [self.decode(net_outs, input_height, input_width, threshold, index) for index in range(len(tiles))]
+
+    def decode(self, net_outs, input_height, input_width, threshold, batch_index=0):
+        scores_list = []
+        bboxes_list = []
+        kpss_list = []
+        fmc = self.fmc
+        for idx, stride in enumerate(self._feat_stride_fpn):
+            # If model support batch dim, take the output of this image
+            if self.batched:
+                scores = net_outs[idx][batch_index]
+                bbox_preds = net_outs[idx + fmc][batch_index] * stride
+                if self.use_kps:
+                    kps_preds = net_outs[idx + fmc * 2][batch_index] * stride
+            else:
+                scores = net_outs[idx]
+                bbox_preds = net_outs[idx + fmc] * stride
+                if self.use_kps:
+                    kps_preds = net_outs[idx + fmc * 2] * stride
+            height = input_height // stride
+            width = input_width // stride
+            key = (height, width, stride)
+            if key in self.center_cache:
+                anchor_centers = self.center_cache[key]
+            else:
+                anchor_centers = numpy.stack(numpy.mgrid[:height, :width][::-1], axis=-1).astype(numpy.float32)
+                anchor_centers = (anchor_centers * stride).reshape((-1, 2))
+                if self._num_anchors > 1:
+                    anchor_centers = numpy.stack([anchor_centers] * self._num_anchors, axis=1).reshape((-1, 2))
+                if len(self.center_cache) < 100:
+                    self.center_cache[key] = anchor_centers
+            pos_inds = numpy.where(scores >= threshold)[0]
+            bboxes = distance2bbox(anchor_centers, bbox_preds)
+            scores_list.append(scores[pos_inds])
+            bboxes_list.append(bboxes[pos_inds])
+            if self.use_kps:
+                kpss = distance2kps(anchor_centers, kps_preds)
+                kpss = kpss.reshape((kpss.shape[0], -1, 2))
+                kpss_list.append(kpss[pos_inds])
+        return scores_list, bboxes_list, kpss_list
+
+    def filter_max_num(self, det, kpss, img_shape, max_num, metric):
+        # keep the top 'max_num' boxes.
+        top_index = rank_detections(det, img_shape, metric)[0:max_num]
         det = det[top_index, :]
         if kpss is not None:
             kpss = kpss[top_index, :]
@@ -40,9 +192,7 @@ class SCRFD_Child(SCRFD):
             new_width = input_size[0]
             new_height = int(new_width * im_ratio)
         det_scale = float(new_height) / img.shape[0]
-        resized_img = cv2.resize(img, (new_width, new_height))
-        det_img = numpy.zeros( (input_size[1], input_size[0], 3), dtype=numpy.uint8 )
-        det_img[:new_height, :new_width, :] = resized_img
+        det_img = self.get_det_img(img, tuple(input_size), new_width, new_height)
         # add threshold for SCRFD
         det_thresh = thresh if thresh is not None else self.det_thresh
         scores_list, bboxes_list, kpss_list = self.forward(det_img, det_thresh)
@@ -65,6 +215,43 @@ class SCRFD_Child(SCRFD):
             det, kpss = self.filter_max_num(det, kpss, img.shape, max_num, metric)
         return det, kpss
 
+    # split a large frame into overlapping tiles of tile_size pixels that each go through the detector
+    # at input_size, plus one pass over the whole frame for the faces too large for a tile.
+    def detect_tiled(self, img, tile_size, input_size=(640, 640), thresh=None, max_num=0, metric='default'):
+        det_thresh = thresh if thresh is not None else self.det_thresh
+        height, width = img.shape[0:2]
+        scale = float(input_size[0]) / tile_size
+        overlap = int(tile_size * TILE_OVERLAP)
+        edge = TILE_EDGE_MARGIN / scale
+        tiles = []
+        offsets = []
+        for y in get_tile_starts(height, tile_size, overlap):
+            for x in get_tile_starts(width, tile_size, overlap):
+                tiles.append((img[y:y + tile_size, x:x + tile_size], scale))
+                offsets.append((x, y))
+        dets_list = []
+        kpss_list = []
+        for (crop, _), (x, y), (scores_list, bboxes_list, tile_kpss_list) in zip(tiles, offsets, self.forward_tiles(tiles, input_size, det_thresh)):
+            bboxes = numpy.vstack(bboxes_list) / scale + (x, y, x, y)
+            kpss = numpy.vstack(tile_kpss_list) / scale + (x, y)
+            right, bottom = x + crop.shape[1], y + crop.shape[0]
+            # faces cut by an inner tile edge are seen whole by the overlapping neighbour or the whole frame pass
+            whole = ((x == 0) | (bboxes[:, 0] > x + edge)) & ((y == 0) | (bboxes[:, 1] > y + edge)) \
+                & ((right == width) | (bboxes[:, 2] < right - edge)) & ((bottom == height) | (bboxes[:, 3] < bottom - edge))
+            dets_list.append(numpy.hstack((bboxes, numpy.vstack(scores_list)))[whole])
+            kpss_list.append(kpss[whole])
+        det, kpss = self.detect(img, input_size=input_size, thresh=det_thresh)
+        dets_list.append(det)
+        kpss_list.append(kpss)
+        pre_det = numpy.vstack(dets_list).astype(numpy.float32, copy=False)
+        kpss = numpy.vstack(kpss_list)
+        keep = self.nms(pre_det)
+        det = pre_det[keep, :]
+        kpss = kpss[keep, :, :]
+        if max_num > 0 and det.shape[0] > max_num:
+            det, kpss = self.filter_max_num(det, kpss, img.shape, max_num, metric)
+        return det, kpss
+
     # add autodetect for improving the performance.
     def autodetect(self, img, max_num=0, metric='max'):
         # use different input size to detect face, intend to improve the recall rate of detection.
@@ -90,4 +277,68 @@ class ArcFaceONNX_Child(ArcFaceONNX):
     def get(self, img, face):
         aimg = face_align.norm_crop(img, landmark=face, image_size=self.input_size[0])
         embedding = self.get_feat(aimg).flatten()
-        return embedding
\ No newline at end of file
+        return embedding
+
+    # vectorised compute_sim between every row of feats and every row of ref_feats.
+    @staticmethod
+    def compute_sim_many(feats, ref_feats):
+        feats = feats / numpy.linalg.norm(feats, axis=1, keepdims=True)
+        ref_feats = ref_feats / numpy.linalg.norm(ref_feats, axis=1, keepdims=True)
+        return numpy.dot(feats, ref_feats.T)
+
+
+class INSwapper_Child(INSwapper):
+    # same as INSwapper.get but the blob and the latent are prepared in the bound input buffers of a pooled session
+    def get(self, img, target_face, source_face, paste_back=True):
+        aimg, M = face_align.norm_crop2(img, target_face.kps, self.input_size[0])
+        with self.session.checkout() as session:
+            inputs = session.get_input_buffers({
+                self.input_names[0]: (1, 3, self.input_size[1], self.input_size[0]),
+                self.input_names[1]: (1, self.emap.shape[1])
+            })
+            blob, latent = inputs[self.input_names[0]], inputs[self.input_names[1]]
+            fill_blob(blob, aimg, self.input_mean, self.input_std)
+            latent[...] = numpy.dot(source_face.normed_embedding.reshape((1, -1)), self.emap)
+            latent /= numpy.linalg.norm(latent)
+            pred = session.run(self.output_names, inputs)[0]
+            img_fake = pred.transpose((0, 2, 3, 1))[0]
+            bgr_fake = numpy.clip(255 * img_fake, 0, 255).astype(numpy.uint8)[:, :, ::-1]
+        if not paste_back:
+            return bgr_fake, M
+        return self.paste_back(img, aimg, bgr_fake, M)
+
+    def paste_back(self, target_img, aimg, bgr_fake, M):
+        fake_diff = bgr_fake.astype(numpy.float32) - aimg.astype(numpy.float32)
+        fake_diff = numpy.abs(fake_diff).mean(axis=2)
+        fake_diff[:2, :] = 0
+        fake_diff[-2:, :] = 0
+        fake_diff[:, :2] = 0
+        fake_diff[:, -2:] = 0
+        IM = cv2.invertAffineTransform(M)
+        img_white = numpy.full((aimg.shape[0], aimg.shape[1]), 255, dtype=numpy.float32)
+        bgr_fake = cv2.warpAffine(bgr_fake, IM, (target_img.shape[1], target_img.shape[0]), borderValue=0.0)
+        img_white = cv2.warpAffine(img_white, IM, (target_img.shape[1], target_img.shape[0]), borderValue=0.0)
+        fake_diff = cv2.warpAffine(fake_diff, IM, (target_img.shape[1], target_img.shape[0]), borderValue=0.0)
+        img_white[img_white > 20] = 255
+        fthresh = 10
+        fake_diff[fake_diff < fthresh] = 0
+        fake_diff[fake_diff >= fthresh] = 255
+        img_mask = img_white
+        mask_h_inds, mask_w_inds = numpy.where(img_mask == 255)
+        mask_h = numpy.max(mask_h_inds) - numpy.min(mask_h_inds)
+        mask_w = numpy.max(mask_w_inds) - numpy.min(mask_w_inds)
+        mask_size = int(numpy.sqrt(mask_h * mask_w))
+        k = max(mask_size // 10, 10)
+        kernel = numpy.ones((k, k), numpy.uint8)
+        img_mask = cv2.erode(img_mask, kernel, iterations=1)
+        kernel = numpy.ones((2, 2), numpy.uint8)
+        fake_diff = cv2.dilate(fake_diff, kernel, iterations=1)
+        k = max(mask_size // 20, 5)
+        blur_size = (2 * k + 1, 2 * k + 1)
+        img_mask = cv2.GaussianBlur(img_mask, blur_size, 0)
+        fake_diff = cv2.GaussianBlur(fake_diff, (11, 11), 0)
+        img_mask /= 255
+        fake_diff /= 255
+        img_mask = numpy.reshape(img_mask, [img_mask.shape[0], img_mask.shape[1], 1])
+        fake_merged = img_mask * bgr_fake + (1 - img_mask) * target_img.astype(numpy.float32)
+        return fake_merged.astype(numpy.uint8)
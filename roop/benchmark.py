@@ -0,0 +1,87 @@
+import os
+import sys
+import time
+import tracemalloc
+import numpy
+from insightface.app.common import Face
+from insightface.model_zoo import SCRFD
+from insightface.model_zoo.inswapper import INSwapper
+from roop.app import nms, SCRFD_Child, INSwapper_Child
+from roop.resources import get_model_paths
+from roop.sessions import create_session, get_session_pool
+
+MEGABYTE = 1024 * 1024
+
+
+def create_crowd_detections(num_faces, candidates_per_face=8, frame_size=(3840, 2160)):
+    # every face yields a cluster of jittered candidates like the anchors of a real detector pass
+    rng = numpy.random.default_rng(0)
+    centers = rng.uniform((0, 0), frame_size, (num_faces, 2))
+    sizes = rng.uniform(20, 200, (num_faces, 1))
+    centers = numpy.repeat(centers, candidates_per_face, axis=0) + rng.normal(0, 3, (num_faces * candidates_per_face, 2))
+    sizes = numpy.repeat(sizes, candidates_per_face, axis=0) * rng.uniform(0.9, 1.1, (num_faces * candidates_per_face, 1))
+    scores = rng.uniform(0.5, 1, (num_faces * candidates_per_face, 1))
+    return numpy.hstack((centers - sizes / 2, centers + sizes / 2, scores)).astype(numpy.float32)
+
+
+def time_function(function, *args, repeat=20):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        timings.append(time.perf_counter() - start)
+    return min(timings) * 1000
+
+
+def measure_allocation(function, *args, repeat=20):
+    # the first call allocates the bound buffers, only the steady state counts
+    function(*args)
+    tracemalloc.start()
+    allocations = []
+    for _ in range(repeat):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        function(*args)
+        allocations.append(tracemalloc.get_traced_memory()[1] - before)
+    tracemalloc.stop()
+    return max(allocations) / MEGABYTE
+
+
+def benchmark_nms(face_counts=(10, 50, 200, 500)):
+    detector = SCRFD.__new__(SCRFD)
+    detector.nms_thresh = 0.4
+    for num_faces in face_counts:
+        dets = create_crowd_detections(num_faces)
+        loop_time = time_function(SCRFD.nms, detector, dets)
+        vectorised_time = time_function(nms, dets, detector.nms_thresh)
+        print(f'nms with {num_faces} faces ({dets.shape[0]} candidates): loop {loop_time:.2f} ms, vectorised {vectorised_time:.2f} ms')
+
+
+def benchmark_bindings():
+    swapper_path, detector_path, _ = get_model_paths()
+    if not os.path.isfile(swapper_path) or not os.path.isfile(detector_path):
+        print('bindings benchmark needs inswapper_128.onnx and the buffalo_l models')
+        return
+    rng = numpy.random.default_rng(0)
+    det_img = rng.integers(0, 255, (640, 640, 3), dtype=numpy.uint8)
+    frame = rng.integers(0, 255, (1080, 1920, 3), dtype=numpy.uint8)
+    kps = numpy.array([[920, 500], [1000, 500], [960, 550], [930, 600], [990, 600]], dtype=numpy.float32)
+    face = Face(kps=kps, embedding=rng.normal(size=512).astype(numpy.float32))
+    for name, plain, bound, args in (
+        ('detector', SCRFD(detector_path, create_session(detector_path)).forward, SCRFD_Child(detector_path, get_session_pool(detector_path)).forward, (det_img, 0.5)),
+        ('swapper', INSwapper(swapper_path, create_session(swapper_path)).get, INSwapper_Child(swapper_path, get_session_pool(swapper_path)).get, (frame, face, face, False))
+    ):
+        plain_time, bound_time = time_function(plain, *args), time_function(bound, *args)
+        plain_allocation, bound_allocation = measure_allocation(plain, *args), measure_allocation(bound, *args)
+        print(f'{name}: session.run {plain_time:.2f} ms allocating {plain_allocation:.2f} MB per call, io binding {bound_time:.2f} ms allocating {bound_allocation:.2f} MB per call')
+
+
+BENCHMARKS = {
+    'nms': benchmark_nms,
+    'bindings': benchmark_bindings
+}
+
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or BENCHMARKS:
+        BENCHMARKS[name]()
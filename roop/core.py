@@ -8,20 +8,25 @@ if any(arg.startswith('--gpu-vendor') for arg in sys.argv):
 import platform
 import signal
 import shutil
-import glob
 import argparse
 import psutil
 import torch
 import tensorflow
 from pathlib import Path
+from collections import Counter
 import multiprocessing as mp
 from opennsfw2 import predict_video_frames, predict_image
 import cv2
 
 import roop.globals
-from roop.swapper import process_video, process_img, process_faces, Facecheck
-from roop.utils import is_img, detect_fps, set_fps, create_video, add_audio, extract_frames, rreplace
-from roop.analyser import get_face_single
+from roop.swapper import process_video, process_img, process_faces, get_source_face, get_face_map, print_skipped_faces, Facecheck
+from roop.utils import is_img, detect_fps, set_fps, create_video, add_audio, extract_frames, get_frame_paths, read_frame, rreplace
+from roop.resources import plan_resources
+from roop.tuning import auto_tune
+from roop.sessions import print_session_metrics
+from roop.manifest import Manifest, PENDING, get_job_key
+from roop.live import run_live
+from roop.server import run_server
 import roop.ui as ui
 
 
@@ -33,17 +38,50 @@ parser.add_argument('-o', '--output', help='save output to this file', dest='out
 parser.add_argument('--keep-fps', help='maintain original fps', dest='keep_fps', action='store_true', default=False)
 parser.add_argument('--keep-frames', help='keep frames directory', dest='keep_frames', action='store_true', default=False)
 parser.add_argument('--all-faces', help='swap all faces in frame', dest='all_faces', action='store_true')
+parser.add_argument('--max-faces', help='swap at most this many faces per frame with --all-faces or --face-map', dest='max_faces', type=int)
+parser.add_argument('--face-time-budget', help='stop swapping further faces of a frame after this many ms', dest='face_time_budget', type=int)
+parser.add_argument('--face-priority', help='which faces go first when a budget is set', dest='face_priority', choices=['size', 'center', 'identity'], default='size')
+parser.add_argument('--skip-faceless', help='pass frames without faces through untouched after a quick low resolution check', dest='skip_faceless', action='store_true', default=False)
+parser.add_argument('--tiled-detection', help='detect small faces in 4K and larger frames on overlapping tiles', dest='tiled_detection', action='store_true', default=False)
+parser.add_argument('--frame-format', help='image format of the intermediate frames', dest='frame_format', choices=['png', 'bmp', 'jpg', 'npy'], default='png')
+parser.add_argument('--png-compression', help='compression level of png frames, 0 is fastest', dest='png_compression', type=int, choices=range(10), default=1)
+parser.add_argument('--temp-dir', help='directory for the intermediate frames, e.g. a tmpfs', dest='temp_dir')
 parser.add_argument('--max-memory', help='maximum amount of RAM in GB to be used', dest='max_memory', type=int)
 parser.add_argument('--cpu-cores', help='number of CPU cores to use', dest='cpu_cores', type=int, default=max(psutil.cpu_count() / 2, 1))
 parser.add_argument('--gpu-threads', help='number of threads to be use for the GPU', dest='gpu_threads', type=int, default=8)
 parser.add_argument('--gpu-vendor', help='choice your GPU vendor', dest='gpu_vendor', choices=['apple', 'amd', 'intel', 'nvidia'])
+parser.add_argument('--session-replicas', help='independent session replicas per model, threads beyond that share one, more use more memory but contend less', dest='session_replicas', type=int, default=1)
+parser.add_argument('--auto-tune', help='calibrate threads on the first frames and cache the result', dest='auto_tune', action='store_true', default=False)
 parser.add_argument('--specific-face', help='specific this face',dest='swapped_face')
+parser.add_argument('--live', help='swap faces live from a capture device index, stream url or video file', dest='live_source')
+parser.add_argument('--live-output', help='window, or ffmpeg output arguments for the live stream', dest='live_output', default='window')
+parser.add_argument('--latency-budget', help='latency budget in ms per live frame', dest='latency_budget', type=int, default=100)
+parser.add_argument('--server', help='serve swap jobs over http on a loopback HOST:PORT or a unix socket path', dest='server_address')
+parser.add_argument('--server-workers', help='number of image jobs the server runs at once', dest='server_workers', type=int, default=2)
+parser.add_argument('--face-map', help='swap faces matching REFERENCE with SOURCE, can be repeated', dest='face_map', action='append', metavar='REFERENCE=SOURCE')
 
 args = parser.parse_known_args()[0]
 
 if 'all_faces' in args:
     roop.globals.all_faces = True
 
+roop.globals.max_faces = args.max_faces
+roop.globals.face_time_budget = args.face_time_budget
+roop.globals.face_priority = args.face_priority
+
+if args.skip_faceless:
+    roop.globals.skip_faceless = True
+
+if args.tiled_detection:
+    roop.globals.tiled_detection = True
+
+roop.globals.frame_format = args.frame_format
+roop.globals.png_compression = args.png_compression
+roop.globals.temp_dir = args.temp_dir
+
+if args.face_map:
+    roop.globals.face_map = [tuple(pair.split('=', 1)) for pair in args.face_map]
+
 if args.cpu_cores:
     roop.globals.cpu_cores = int(args.cpu_cores)
 
@@ -58,15 +96,20 @@ if args.gpu_threads:
 if args.gpu_vendor == 'amd':
     roop.globals.gpu_threads = 1
 
+if args.max_memory:
+    roop.globals.max_memory = args.max_memory
+
+if args.session_replicas:
+    roop.globals.session_replicas = args.session_replicas
+
+if args.auto_tune:
+    roop.globals.auto_tune = True
+
 if args.gpu_vendor:
     roop.globals.gpu_vendor = args.gpu_vendor
 else:
     roop.globals.providers = ['CPUExecutionProvider']
 
-sep = "/"
-if os.name == "nt":
-    sep = "\\"
-
 
 def limit_resources():
     # prevent tensorflow memory leak
@@ -149,31 +192,37 @@ def status(string):
         ui.update_status_label(value)
 
 
-def process_video_multi_cores(source_img, frame_paths):
+def process_video_multi_cores(source_img, frame_paths, manifest):
     n = len(frame_paths) // roop.globals.cpu_cores
     if n > 2:
         processes = []
         for i in range(0, len(frame_paths), n):
-            p = POOL.apply_async(process_video, args=(source_img, frame_paths[i:i + n],))
+            p = POOL.apply_async(process_video, args=(source_img, frame_paths[i:i + n], manifest))
             processes.append(p)
+        skipped_faces = Counter()
         for p in processes:
-            p.get()
+            skipped_faces.update(p.get())
         POOL.close()
         POOL.join()
+        print_skipped_faces(skipped_faces)
 
 
 def start(preview_callback = None):
-    if not args.source_img or not os.path.isfile(args.source_img):
+    if roop.globals.face_map:
+        if not all(len(pair) == 2 and all(os.path.isfile(path) for path in pair) for pair in roop.globals.face_map):
+            print("\n[WARNING] Please give --face-map as pairs of existing images: REFERENCE=SOURCE.")
+            return
+    elif not args.source_img or not os.path.isfile(args.source_img):
         print("\n[WARNING] Please select an image containing a face.")
         return
-    elif not args.target_path or not os.path.isfile(args.target_path):
+    if not args.target_path or not os.path.isfile(args.target_path):
         print("\n[WARNING] Please select a video/image to swap face in.")
         return
     if not args.output_file:
         target_path = args.target_path
         args.output_file = rreplace(target_path, "/", "/swapped-", 1) if "/" in target_path else "swapped-" + target_path
     target_path = args.target_path
-    test_face = get_face_single(cv2.imread(args.source_img))
+    test_face = get_face_map()[1] if roop.globals.face_map else get_source_face(args.source_img)
     if not test_face:
         print("\n[WARNING] No face detected in source image. Please try with another one.\n")
         return
@@ -186,47 +235,53 @@ def start(preview_callback = None):
     seconds, probabilities = predict_video_frames(video_path=args.target_path, frame_interval=100)
     if any(probability > 0.85 for probability in probabilities):
         quit()
-    face_checker = Facecheck()
     video_name_full = os.path.basename(target_path)
     video_name = os.path.splitext(video_name_full)[0]
-    output_dir = os.path.join(os.path.dirname(target_path), video_name) if os.path.dirname(target_path) else video_name
-    subdir = os.path.join(output_dir, 'subdir')
-    Path(output_dir).mkdir(exist_ok=True)
-    Path(subdir).mkdir(exist_ok=True)
+    output_dir = os.path.join(roop.globals.temp_dir or os.path.dirname(target_path), video_name)
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    job = get_job_key(args.target_path, args.source_img, args.swapped_face, args.keep_fps)
+    manifest = Manifest.load(output_dir, job)
+    # pending frames are left over from an interrupted run of this job, continue that one
+    if manifest and not manifest.count(PENDING):
+        manifest.remove()
+        manifest = None
     status("detecting video's FPS...")
     fps, exact_fps = detect_fps(target_path)
     if not args.keep_fps and fps > 30:
         this_path = os.path.join(output_dir, video_name + ".mp4")
-        set_fps(target_path, this_path, 30)
+        if manifest is None:
+            set_fps(target_path, this_path, 30)
         target_path, exact_fps = this_path, 30
     else:
         shutil.copy(target_path, output_dir)
-    status("extracting frames...")
-    extract_frames(target_path, output_dir)
-    args.frame_paths = tuple(sorted(
-        glob.glob(output_dir + "/*.png"),
-        key=lambda x: int(x.split(sep)[-1].replace(".png", ""))
-    ))
-    status("preparing the faces")
-    # checking frame_paths output should be processed img.
-    if args.swapped_face is not None:
-        face_checker.get(args.swapped_face, args.frame_paths, subdir)
+    if manifest is None:
+        status("extracting frames...")
+        # frames of an earlier job, a longer video leaves more of them than this one extracts
+        for frame_path in get_frame_paths(output_dir):
+            os.remove(frame_path)
+        extract_frames(target_path, output_dir)
+        manifest = Manifest.create(output_dir, len(get_frame_paths(output_dir)), job)
     else:
-        for frame in args.frame_paths:
-            shutil.move(frame, subdir, copy_function=shutil.copy2)
-    args.subdir_paths = tuple(sorted(
-        glob.glob(subdir + "/*.png"),
-        key=lambda x: int(x.split(sep)[-1].replace(".png", ""))
-    ))
+        status("resuming interrupted swap...")
+    # frames without the specific face are filtered in the manifest, nothing is moved.
+    # a filter interrupted half way goes over the pending frames again
+    if args.swapped_face is not None and not manifest.is_filtered():
+        status("preparing the faces")
+        Facecheck().get(args.swapped_face, manifest)
+    args.frame_paths = manifest.get_paths(PENDING)
+    if args.frame_paths:
+        plan_resources(read_frame(args.frame_paths[0]).shape)
+        if roop.globals.auto_tune:
+            status("tuning threads...")
+            auto_tune(args.source_img, args.frame_paths)
     status("swapping in progress...")
     if roop.globals.gpu_vendor is None and roop.globals.cpu_cores > 1:
         global POOL
         POOL = mp.Pool(roop.globals.cpu_cores)
-        process_video_multi_cores(args.source_img, args.subdir_paths)
+        process_video_multi_cores(args.source_img, args.frame_paths, manifest)
     else:
-        process_video(args.source_img, args.subdir_paths)
-    for swappered in args.subdir_paths:
-        shutil.move(swappered, output_dir, copy_function=shutil.copy2)
+        print_skipped_faces(process_video(args.source_img, args.frame_paths, manifest))
+        print_session_metrics()
 
     # prevent out of memory while using ffmpeg with cuda
     if args.gpu_vendor == 'nvidia':
@@ -270,7 +325,7 @@ def save_file_handler(path: str):
 
 def create_test_preview(frame_number):
     return process_faces(
-        get_face_single(cv2.imread(args.source_img)),
+        get_source_face(args.source_img),
         get_video_frame(args.target_path, frame_number)
     )
 
@@ -280,7 +335,13 @@ def run():
 
     pre_check()
     limit_resources()
-    if args.source_img:
+    if args.server_address:
+        run_server(args.server_address, args.server_workers)
+        quit()
+    if args.live_source:
+        run_live(args.source_img, args.live_source, args.live_output, args.latency_budget / 1000)
+        quit()
+    if args.source_img or roop.globals.face_map:
         args.cli_mode = True
         start()
         quit()
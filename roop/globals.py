@@ -1,10 +1,23 @@
 import onnxruntime
 
 all_faces = None
+face_map = None
+max_faces = None
+face_time_budget = None
+face_priority = 'size'
+skip_faceless = False
+tiled_detection = False
 log_level = 'error'
 cpu_cores = None
 gpu_threads = None
 gpu_vendor = None
+max_memory = None
+frame_format = 'png'
+png_compression = 1
+temp_dir = None
+auto_tune = False
+intra_op_threads = None
+session_replicas = 1
 providers = onnxruntime.get_available_providers()
 
 if 'TensorrtExecutionProvider' in providers:
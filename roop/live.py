@@ -0,0 +1,157 @@
+import os
+import time
+import shlex
+import threading
+import subprocess
+import numpy
+import cv2
+from insightface.app.common import Face
+import roop.globals
+from roop.analyser import get_face_analyser, DetectionState
+from roop.swapper import get_source_face, get_face_map, get_face_pairs, swap_face_pairs, print_skipped_faces
+
+TRACKING_SIZE = (320, 320)
+
+
+class LiveReader:
+
+    def __init__(self, source):
+        self.capture = cv2.VideoCapture(int(source) if source.isdigit() else source)
+        if not self.capture.isOpened():
+            raise IOError(f"Error opening live source {source}")
+        self.fps = self.capture.get(cv2.CAP_PROP_FPS) or 30
+        # local files are replayed at their native speed so they behave like a camera
+        self.realtime = os.path.isfile(source)
+        self.condition = threading.Condition()
+        self.frame = None
+        self.captured_at = None
+        self.dropped = 0
+        self.running = True
+        threading.Thread(target=self.read, daemon=True).start()
+
+    def read(self):
+        started = time.perf_counter()
+        frame_number = 0
+        while self.running:
+            ret, frame = self.capture.read()
+            if not ret:
+                break
+            if self.realtime:
+                frame_number += 1
+                delay = started + frame_number / self.fps - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            with self.condition:
+                # nobody picked up the previous frame in time, it is stale now
+                if self.frame is not None:
+                    self.dropped += 1
+                self.frame = frame
+                self.captured_at = time.perf_counter()
+                self.condition.notify()
+        self.capture.release()
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+    def get(self):
+        with self.condition:
+            while self.frame is None and self.running:
+                self.condition.wait()
+            frame, captured_at = self.frame, self.captured_at
+            self.frame = None
+        return frame, captured_at
+
+    def stop(self):
+        self.running = False
+
+
+class LiveOutput:
+
+    def __init__(self, live_output, frame_shape, fps):
+        self.process = None
+        if live_output != 'window':
+            height, width = frame_shape[:2]
+            command = ['ffmpeg', '-hide_banner', '-loglevel', roop.globals.log_level, '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{width}x{height}', '-r', str(fps), '-i', '-', '-y']
+            self.process = subprocess.Popen(command + shlex.split(live_output), stdin=subprocess.PIPE)
+
+    def write(self, frame):
+        if self.process:
+            try:
+                self.process.stdin.write(frame.tobytes())
+                return True
+            except BrokenPipeError:
+                return False
+        cv2.imshow('roop', frame)
+        return cv2.waitKey(1) & 0xFF != ord('q')
+
+    def close(self):
+        if self.process:
+            self.process.stdin.close()
+            self.process.wait()
+        else:
+            cv2.destroyAllWindows()
+
+
+def track_face_pairs(face_pairs, frame):
+    # a bare detector pass at low resolution moves the faces of the last full analysis to their new spot
+    bboxes, kpss = get_face_analyser().det_model.detect(frame, input_size=TRACKING_SIZE)
+    if not face_pairs or bboxes.shape[0] == 0:
+        return []
+    previous_centers = numpy.array([(face.bbox[:2] + face.bbox[2:4]) / 2 for _, face in face_pairs])
+    previous_widths = numpy.array([face.bbox[2] - face.bbox[0] for _, face in face_pairs])
+    tracked_pairs = []
+    for bbox, kps in zip(bboxes, kpss):
+        distances = numpy.linalg.norm(previous_centers - (bbox[:2] + bbox[2:4]) / 2, axis=1)
+        nearest = distances.argmin()
+        if distances[nearest] < previous_widths[nearest]:
+            tracked_pairs.append((face_pairs[nearest][0], Face(bbox=bbox[:4], kps=kps, det_score=bbox[4])))
+    return tracked_pairs
+
+
+def print_latency_report(latencies, processed, dropped, tracked):
+    if not latencies:
+        return
+    p50, p90, p99 = numpy.percentile(numpy.array(latencies) * 1000, [50, 90, 99])
+    print(f"\n\nLive: {processed} frames processed, {dropped} dropped, {tracked} tracking-only")
+    print(f"Latency: p50 {p50:.1f} ms, p90 {p90:.1f} ms, p99 {p99:.1f} ms\n\n")
+
+
+def run_live(source_img, live_source, live_output, latency_budget):
+    if not roop.globals.face_map and (not source_img or not os.path.isfile(source_img)):
+        print("\n[WARNING] Please select an image containing a face.")
+        return
+    source_face = get_source_face(source_img)
+    if not (get_face_map()[1] if roop.globals.face_map else source_face):
+        print("\n[WARNING] No face detected in source image. Please try with another one.\n")
+        return
+    state = DetectionState()
+    reader = LiveReader(live_source)
+    output = None
+    face_pairs = []
+    latencies = []
+    tracked = 0
+    behind = False
+    try:
+        while True:
+            frame, captured_at = reader.get()
+            if frame is None:
+                break
+            # the last frame blew the budget, follow the known faces instead of analysing again
+            if behind and face_pairs:
+                face_pairs = track_face_pairs(face_pairs, frame)
+                tracked += 1
+            else:
+                face_pairs = get_face_pairs(source_face, frame, state)
+            result = swap_face_pairs(face_pairs, frame)
+            if output is None:
+                output = LiveOutput(live_output, frame.shape, reader.fps)
+            if not output.write(result):
+                break
+            latencies.append(time.perf_counter() - captured_at)
+            behind = latencies[-1] > latency_budget
+    finally:
+        reader.stop()
+        if output:
+            output.close()
+    print_latency_report(latencies, len(latencies), reader.dropped, tracked)
+    print_skipped_faces()
@@ -0,0 +1,130 @@
+import os
+import json
+import numpy
+from numpy.lib.format import open_memmap
+import roop.globals
+
+PENDING = 0
+FILTERED = 1
+SWAPPED = 2
+SKIPPED = 3
+FAILED = 4
+MANIFEST_NAME = 'manifest.npy'
+# written once the specific face filter went over every frame
+FILTERED_NAME = 'manifest.filtered'
+# the target and the options the frames were swapped with, a manifest of another job is not resumed
+JOB_NAME = 'manifest.json'
+MANIFEST_DTYPE = numpy.dtype([
+    ('frame_number', numpy.uint32),
+    ('state', numpy.uint8),
+    ('faces', numpy.uint16),
+    ('similarity', numpy.float32)
+])
+
+
+class Manifest:
+    # one record per extracted frame, memory mapped so pool workers update the same file
+    # and an interrupted run can pick up where it stopped.
+
+    def __init__(self, frame_dir, mode='r+', frame_count=None):
+        self.frame_dir = frame_dir
+        self.path = os.path.join(frame_dir, MANIFEST_NAME)
+        self.filtered_path = os.path.join(frame_dir, FILTERED_NAME)
+        self.job_path = os.path.join(frame_dir, JOB_NAME)
+        if mode == 'w+':
+            if os.path.isfile(self.filtered_path):
+                os.remove(self.filtered_path)
+            self.frames = open_memmap(self.path, mode='w+', dtype=MANIFEST_DTYPE, shape=(frame_count,))
+            self.frames['frame_number'] = numpy.arange(1, frame_count + 1)
+            self.frames.flush()
+        else:
+            self.frames = open_memmap(self.path, mode=mode)
+
+    @classmethod
+    def create(cls, frame_dir, frame_count, job):
+        manifest = cls(frame_dir, 'w+', frame_count)
+        with open(manifest.job_path, 'w') as file:
+            json.dump(job, file)
+        return manifest
+
+    @classmethod
+    def load(cls, frame_dir, job):
+        if not os.path.isfile(os.path.join(frame_dir, MANIFEST_NAME)):
+            return None
+        manifest = cls(frame_dir)
+        if manifest.get_job() != job:
+            manifest.remove()
+            return None
+        return manifest
+
+    # only the location travels to the pool workers, they map the file themselves
+    def __getstate__(self):
+        return {'frame_dir': self.frame_dir}
+
+    def __setstate__(self, state):
+        self.__init__(state['frame_dir'])
+
+    def get_path(self, frame_number):
+        return os.path.join(self.frame_dir, f'{frame_number:04d}.{roop.globals.frame_format}')
+
+    def get_paths(self, state):
+        return tuple(self.get_path(frame_number) for frame_number in self.frames['frame_number'][self.frames['state'] == state])
+
+    def count(self, state):
+        return int(numpy.count_nonzero(self.frames['state'] == state))
+
+    def get_index(self, frame_path):
+        return int(os.path.splitext(os.path.basename(frame_path))[0]) - 1
+
+    def mark(self, frame_path, state):
+        self.frames['state'][self.get_index(frame_path)] = state
+
+    def set_faces(self, frame_path, faces, similarity):
+        index = self.get_index(frame_path)
+        self.frames['faces'][index] = faces
+        self.frames['similarity'][index] = similarity
+
+    def flush(self):
+        self.frames.flush()
+
+    def get_job(self):
+        if not os.path.isfile(self.job_path):
+            return None
+        with open(self.job_path) as file:
+            return json.load(file)
+
+    def is_filtered(self):
+        return os.path.isfile(self.filtered_path)
+
+    def set_filtered(self):
+        self.flush()
+        open(self.filtered_path, 'w').close()
+
+    def remove(self):
+        del self.frames
+        os.remove(self.path)
+        if self.is_filtered():
+            os.remove(self.filtered_path)
+        if os.path.isfile(self.job_path):
+            os.remove(self.job_path)
+
+
+def get_file_key(path):
+    # a file replaced under the same name is another file
+    if not path or not os.path.isfile(path):
+        return None
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+
+
+def get_job_key(target_path, source_img, swapped_face, keep_fps):
+    # everything that decides which frames are extracted and how a swapped frame looks, as json would load it
+    return {
+        'target': get_file_key(target_path),
+        'source': get_file_key(source_img),
+        'face_map': [[get_file_key(reference_path), get_file_key(source_path)] for reference_path, source_path in roop.globals.face_map or []],
+        'all_faces': bool(roop.globals.all_faces),
+        'specific_face': get_file_key(swapped_face),
+        'frame_format': roop.globals.frame_format,
+        'keep_fps': bool(keep_fps)
+    }
@@ -0,0 +1,97 @@
+import os
+import gc
+import time
+import psutil
+import roop.globals
+from roop.utils import FRAME_WRITER_PENDING
+
+# onnxruntime keeps an arena and intermediate tensors on top of the raw weights
+MODEL_OVERHEAD = 1.5
+# a frame is held as uint8 plus the float32 masks and merges of the paste back
+FRAME_BYTES_PER_PIXEL = 40
+# keep some room for ffmpeg, python objects and allocator fragmentation
+BUDGET_HEADROOM = 0.9
+BACKPRESSURE_INTERVAL = 0.05
+BACKPRESSURE_TIMEOUT = 10
+# reading the memory of every worker is not free, reuse a sample for this long
+MEMORY_SAMPLE_INTERVAL = 0.2
+GIGABYTE = 1024 * 1024 * 1024
+
+ROOT_PID = os.getpid()
+MEMORY_SAMPLE = None
+BACKPRESSURE_TIMED_OUT = False
+
+
+def get_model_paths():
+    swapper_path = os.path.join(os.path.abspath(os.path.dirname(__file__)), '../inswapper_128.onnx')
+    analyser_dir = os.path.expanduser('~/.insightface/models/buffalo_l')
+    return [swapper_path, os.path.join(analyser_dir, 'det_10g.onnx'), os.path.join(analyser_dir, 'w600k_r50.onnx')]
+
+
+def estimate_model_memory():
+    size = sum(os.path.getsize(path) for path in get_model_paths() if os.path.isfile(path))
+    return int(size * MODEL_OVERHEAD * roop.globals.session_replicas)
+
+
+def estimate_frame_memory(frame_shape):
+    # the frame in the swap plus the uint8 frames its writer may hold waiting for the disk
+    return frame_shape[0] * frame_shape[1] * (FRAME_BYTES_PER_PIXEL + FRAME_WRITER_PENDING * 3)
+
+
+def get_memory_budget():
+    if not roop.globals.max_memory:
+        return None
+    return int(roop.globals.max_memory * GIGABYTE * BUDGET_HEADROOM)
+
+
+def get_memory_usage():
+    global MEMORY_SAMPLE
+    if MEMORY_SAMPLE and time.time() - MEMORY_SAMPLE[0] < MEMORY_SAMPLE_INTERVAL:
+        return MEMORY_SAMPLE[1]
+    try:
+        process = psutil.Process(ROOT_PID)
+        usage = process.memory_info().rss
+        # forked workers share the parent's pages, only their unique memory adds to it
+        for child in process.children(recursive=True):
+            usage += child.memory_full_info().uss
+    except psutil.Error:
+        usage = psutil.Process().memory_info().rss
+    MEMORY_SAMPLE = time.time(), usage
+    return usage
+
+
+def plan_resources(frame_shape):
+    budget = get_memory_budget()
+    if budget is None:
+        return
+    model_memory = estimate_model_memory()
+    frame_memory = estimate_frame_memory(frame_shape)
+    available = budget - get_memory_usage()
+    if roop.globals.gpu_vendor is None:
+        # every pool worker loads its own copy of the models and has its own frame and frame writer
+        workers = max(available // (model_memory + frame_memory), 1)
+        roop.globals.cpu_cores = int(min(roop.globals.cpu_cores, workers))
+    else:
+        # gpu threads share one copy of the models but each holds its own frame and frame writer
+        threads = max((available - model_memory) // frame_memory, 1)
+        roop.globals.gpu_threads = int(min(roop.globals.gpu_threads, threads))
+    print(f'Memory budget {budget / GIGABYTE:.1f} GB allows {roop.globals.cpu_cores} cpu cores and {roop.globals.gpu_threads} gpu threads')
+
+
+def wait_for_memory():
+    global BACKPRESSURE_TIMED_OUT
+    budget = get_memory_budget()
+    if budget is None:
+        return
+    if get_memory_usage() < budget:
+        BACKPRESSURE_TIMED_OUT = False
+        return
+    # waiting did not free anything last time, carry on until the usage drops instead of stalling every frame
+    if BACKPRESSURE_TIMED_OUT:
+        return
+    gc.collect()
+    deadline = time.time() + BACKPRESSURE_TIMEOUT
+    # other workers release their frames while we wait, give up after the timeout instead of stalling forever
+    while get_memory_usage() >= budget and time.time() < deadline:
+        time.sleep(BACKPRESSURE_INTERVAL)
+    BACKPRESSURE_TIMED_OUT = get_memory_usage() >= budget
@@ -0,0 +1,255 @@
+import os
+import json
+import time
+import base64
+import shutil
+import socket
+import ipaddress
+import asyncio
+import itertools
+import tempfile
+import numpy
+import cv2
+from opennsfw2 import predict_video_frames, predict_image
+import roop.globals
+from roop.analyser import get_face_single, get_face_analyser
+from roop.swapper import get_face_swapper, get_source_face, process_faces, process_frames, multi_process_frame, SKIPPED_FACES
+from roop.utils import is_img, detect_fps, create_video, extract_frames, add_audio, get_frame_paths
+from roop.sessions import fill_session_pools, get_session_metrics
+
+VIDEO_WORKERS = 1
+NSFW_THRESHOLD = 0.85
+STATUS_TEXT = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+
+class Job:
+
+    def __init__(self, request, loop):
+        self.request = request
+        self.loop = loop
+        self.kind = 'video' if request.get('target_path') and not is_img(request['target_path']) else 'image'
+        # PriorityQueue pops the smallest, jobs with a lower priority value run first
+        self.priority = int(request.get('priority', 0))
+        self.events = asyncio.Queue()
+        self.frames = 0
+        self.total = 0
+
+    # called from the worker threads, hand the progress over to the event loop
+    def update(self, amount=1):
+        self.loop.call_soon_threadsafe(self.add_progress, amount)
+
+    def add_progress(self, amount):
+        self.frames += amount
+        self.events.put_nowait({'status': 'running', 'progress': self.frames / self.total if self.total else 1})
+
+
+class JobServer:
+
+    def __init__(self, image_workers):
+        self.image_workers = image_workers
+        self.queues = {'image': asyncio.PriorityQueue(), 'video': asyncio.PriorityQueue()}
+        self.job_ids = itertools.count(1)
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.frames = 0
+        self.started = time.time()
+
+    def warm_up(self):
+        # load the models once so every job runs on warm sessions
+        get_face_analyser()
+        get_face_swapper()
+        fill_session_pools()
+
+    async def start(self, address):
+        await asyncio.get_running_loop().run_in_executor(None, self.warm_up)
+        for _ in range(self.image_workers):
+            asyncio.create_task(self.work(self.queues['image']))
+        for _ in range(VIDEO_WORKERS):
+            asyncio.create_task(self.work(self.queues['video']))
+        if ':' in address:
+            host, port = address.rsplit(':', 1)
+            server = await asyncio.start_server(self.handle, host.strip('[]'), int(port))
+        else:
+            server = await asyncio.start_unix_server(self.handle, address)
+        print(f"Job server listening on {address}")
+        async with server:
+            await server.serve_forever()
+
+    def get_metrics(self):
+        uptime = time.time() - self.started
+        return {
+            'queue_depth': {kind: queue.qsize() for kind, queue in self.queues.items()},
+            'running': self.running,
+            'completed': self.completed,
+            'failed': self.failed,
+            'frames': self.frames,
+            'jobs_per_second': self.completed / uptime,
+            'frames_per_second': self.frames / uptime,
+            'sessions': get_session_metrics(),
+            'skipped_faces': dict(SKIPPED_FACES)
+        }
+
+    async def work(self, queue):
+        loop = asyncio.get_running_loop()
+        while True:
+            _, job_id, job = await queue.get()
+            self.running += 1
+            job.events.put_nowait({'id': job_id, 'status': 'running', 'progress': 0})
+            try:
+                result = await loop.run_in_executor(None, run_job, job)
+                self.completed += 1
+                self.frames += job.frames
+                job.events.put_nowait(dict(result, id=job_id, status='done'))
+            except Exception as exception:
+                self.failed += 1
+                job.events.put_nowait({'id': job_id, 'status': 'failed', 'error': str(exception)})
+            self.running -= 1
+
+    async def handle(self, reader, writer):
+        try:
+            method, path, body = await read_request(reader)
+            if path == '/metrics' and method == 'GET':
+                await write_json(writer, 200, self.get_metrics())
+            elif path == '/jobs' and method == 'POST':
+                await self.submit(writer, json.loads(body or '{}'))
+            elif path in ('/metrics', '/jobs'):
+                await write_json(writer, 405, {'error': 'method not allowed'})
+            else:
+                await write_json(writer, 404, {'error': 'not found'})
+        except (ValueError, KeyError) as exception:
+            await write_json(writer, 400, {'error': str(exception)})
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def submit(self, writer, request):
+        if not (request.get('source_path') or request.get('source_image')) or not (request.get('target_path') or request.get('target_image')):
+            raise ValueError('a job needs a source and a target, as a path or base64 image')
+        job = Job(request, asyncio.get_running_loop())
+        job_id = next(self.job_ids)
+        job.events.put_nowait({'id': job_id, 'status': 'queued', 'queue_depth': self.queues[job.kind].qsize()})
+        self.queues[job.kind].put_nowait((job.priority, job_id, job))
+        # stream one json line per event until the job has finished
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\nTransfer-Encoding: chunked\r\n\r\n')
+        while True:
+            event = await job.events.get()
+            line = json.dumps(event).encode() + b'\n'
+            writer.write(b'%x\r\n%s\r\n' % (len(line), line))
+            await writer.drain()
+            if event['status'] in ('done', 'failed'):
+                break
+        writer.write(b'0\r\n\r\n')
+        await writer.drain()
+
+
+async def read_request(reader):
+    request_line = (await reader.readline()).decode()
+    if not request_line:
+        raise ConnectionError('connection closed')
+    method, path, _ = request_line.split(' ', 2)
+    headers = {}
+    while True:
+        line = (await reader.readline()).decode().strip()
+        if not line:
+            break
+        name, value = line.split(':', 1)
+        headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get('content-length', 0)))
+    return method, path, body
+
+
+async def write_json(writer, status, data):
+    body = json.dumps(data).encode()
+    writer.write(f'HTTP/1.1 {status} {STATUS_TEXT[status]}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n'.encode() + body)
+    await writer.drain()
+
+
+def decode_image(data):
+    return cv2.imdecode(numpy.frombuffer(base64.b64decode(data), numpy.uint8), cv2.IMREAD_COLOR)
+
+
+def run_job(job):
+    if job.kind == 'video':
+        return run_video_job(job)
+    return run_image_job(job)
+
+
+def get_job_source_face(request):
+    if request.get('source_image'):
+        source_face = get_face_single(decode_image(request['source_image']))
+    else:
+        source_face = get_source_face(request['source_path'])
+    if not source_face:
+        raise ValueError('no face detected in source image')
+    return source_face
+
+
+def run_image_job(job):
+    request = job.request
+    source_face = get_job_source_face(request)
+    if request.get('target_image'):
+        frame = decode_image(request['target_image'])
+        # opennsfw2 only takes paths
+        with tempfile.NamedTemporaryFile(suffix='.png') as file:
+            cv2.imwrite(file.name, frame)
+            if predict_image(file.name) > NSFW_THRESHOLD:
+                raise ValueError('target image was rejected')
+    else:
+        if predict_image(request['target_path']) > NSFW_THRESHOLD:
+            raise ValueError('target image was rejected')
+        frame = cv2.imread(request['target_path'])
+    result = process_faces(source_face, frame)
+    job.total = 1
+    job.update()
+    if request.get('output_path'):
+        cv2.imwrite(request['output_path'], result)
+        return {'output_path': request['output_path']}
+    return {'image': base64.b64encode(cv2.imencode('.png', result)[1].tobytes()).decode()}
+
+
+def run_video_job(job):
+    request = job.request
+    target_path = request['target_path']
+    source_face = get_job_source_face(request)
+    _, probabilities = predict_video_frames(video_path=target_path, frame_interval=100)
+    if any(probability > NSFW_THRESHOLD for probability in probabilities):
+        raise ValueError('target video was rejected')
+    video_name_full = os.path.basename(target_path)
+    video_name = os.path.splitext(video_name_full)[0]
+    output_path = request.get('output_path') or os.path.join(os.path.dirname(target_path), 'swapped-' + video_name + '.mp4')
+    output_dir = tempfile.mkdtemp(prefix='roop-', dir=roop.globals.temp_dir)
+    try:
+        shutil.copy(target_path, output_dir)
+        _, exact_fps = detect_fps(target_path)
+        extract_frames(target_path, output_dir)
+        frame_paths = get_frame_paths(output_dir)
+        job.total = len(frame_paths)
+        if roop.globals.gpu_vendor is not None and roop.globals.gpu_threads > 1:
+            multi_process_frame(None, frame_paths, job, source_face=source_face)
+        else:
+            process_frames(None, frame_paths, job, source_face=source_face)
+        create_video(video_name, exact_fps, output_dir)
+        add_audio(output_dir, target_path, video_name_full, False, output_path)
+    finally:
+        # add_audio only cleans up after a successful job
+        shutil.rmtree(output_dir, ignore_errors=True)
+    return {'output_path': output_path}
+
+
+def is_loopback(host):
+    try:
+        addresses = socket.getaddrinfo(host.strip('[]'), None)
+    except socket.gaierror:
+        return False
+    # every address the name resolves to, a name that also resolves to a public one is refused
+    return all(ipaddress.ip_address(address[4][0]).is_loopback for address in addresses)
+
+
+def run_server(address, image_workers):
+    # jobs read and write any path they name, only local clients may submit them
+    if ':' in address and not is_loopback(address.rsplit(':', 1)[0]):
+        print("\n[WARNING] The job server only listens on a loopback address or a unix socket.\n")
+        return
+    asyncio.run(JobServer(image_workers).start(address))
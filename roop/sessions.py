@@ -0,0 +1,181 @@
+import os
+import queue
+import threading
+import contextlib
+import numpy
+import onnxruntime
+import roop.globals
+
+SESSION_POOLS = {}
+THREAD_LOCK = threading.Lock()
+
+
+class Binding:
+    # one io binding with its own input and output buffers for a fixed set of input shapes
+
+    def __init__(self, session, input_shapes):
+        self.session = session
+        self.io_binding = session.io_binding()
+        self.output_names = [output.name for output in session.get_outputs()]
+        self.outputs = None
+        self.output_values = None
+        # every model roop runs takes float32 inputs
+        self.inputs = {name: numpy.empty(shape, dtype=numpy.float32) for name, shape in input_shapes.items()}
+        for name, buffer in self.inputs.items():
+            self.io_binding.bind_cpu_input(name, buffer)
+
+    def run(self):
+        if self.outputs is not None:
+            self.session.run_with_iobinding(self.io_binding)
+            return self.outputs
+        # the output shapes are only known after a first run, from then on ort writes straight into our buffers
+        for name in self.output_names:
+            self.io_binding.bind_output(name, 'cpu')
+        self.session.run_with_iobinding(self.io_binding)
+        self.outputs = dict(zip(self.output_names, self.io_binding.copy_outputs_to_cpu()))
+        self.output_values = [onnxruntime.OrtValue.ortvalue_from_numpy(self.outputs[name]) for name in self.output_names]
+        for name, value in zip(self.output_names, self.output_values):
+            self.io_binding.bind_ortvalue_output(name, value)
+        return self.outputs
+
+
+class BoundSession:
+    # stands in for an InferenceSession but runs through io binding, with buffers allocated once per
+    # input shape. Only the thread that checked it out of its pool uses it, and the returned outputs
+    # are overwritten by its next run.
+
+    def __init__(self, session):
+        self.session = session
+        self.bindings = {}
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+    def get_binding(self, input_shapes):
+        bindings = self.bindings
+        key = tuple(sorted(input_shapes.items()))
+        if key not in bindings:
+            bindings[key] = Binding(self.session, input_shapes)
+        return bindings[key]
+
+    def get_input_buffers(self, input_shapes):
+        return self.get_binding(input_shapes).inputs
+
+    def run(self, output_names, input_feed):
+        binding = self.get_binding({name: value.shape for name, value in input_feed.items()})
+        for name, value in input_feed.items():
+            # inputs prepared straight into the buffer need no copy
+            if value is not binding.inputs[name]:
+                binding.inputs[name][...] = value
+        outputs = binding.run()
+        return [outputs[name] for name in output_names or binding.output_names]
+
+
+class SessionPool:
+    # independent replicas of one model's session, each checked out by one thread at a time.
+    # When every replica is busy a thread does not wait but runs on the first replica at the same
+    # time, through io binding buffers of its own. More replicas trade memory for less sharing.
+
+    def __init__(self, model_path, size):
+        self.model_path = model_path
+        self.size = max(size, 1)
+        self.replicas = queue.LifoQueue()
+        self.shared = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.checkouts = 0
+        self.shared_checkouts = 0
+        # one replica up front, the models read their input and output metadata from it
+        self.session = BoundSession(create_session(model_path))
+        self.created = 1
+        self.replicas.put(self.session)
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+    def fill(self):
+        while True:
+            with self.lock:
+                if self.created >= self.size:
+                    return
+                self.created += 1
+            self.replicas.put(BoundSession(create_session(self.model_path)))
+
+    def acquire(self):
+        try:
+            return self.replicas.get_nowait(), self.replicas
+        except queue.Empty:
+            pass
+        with self.lock:
+            create = self.created < self.size
+            if create:
+                self.created += 1
+            else:
+                self.shared_checkouts += 1
+        # further replicas are only built once threads actually contend
+        if create:
+            return BoundSession(create_session(self.model_path)), self.replicas
+        # onnxruntime sessions run concurrently, the bindings are what must not be shared
+        try:
+            return self.shared.get_nowait(), self.shared
+        except queue.Empty:
+            return BoundSession(self.session.session), self.shared
+
+    @contextlib.contextmanager
+    def checkout(self):
+        session, returns = self.acquire()
+        with self.lock:
+            self.checkouts += 1
+        try:
+            yield session
+        finally:
+            returns.put(session)
+
+    def run(self, output_names, input_feed):
+        with self.checkout() as session:
+            # the buffers belong to the replica, copy them before another thread gets it
+            return [output.copy() for output in session.run(output_names, input_feed)]
+
+    def get_metrics(self):
+        return {
+            'replicas': self.created,
+            'checkouts': self.checkouts,
+            'shared_checkouts': self.shared_checkouts
+        }
+
+
+def get_session_options():
+    session_options = onnxruntime.SessionOptions()
+    if roop.globals.intra_op_threads:
+        session_options.intra_op_num_threads = roop.globals.intra_op_threads
+    return session_options
+
+
+def create_session(model_path):
+    return onnxruntime.InferenceSession(model_path, get_session_options(), providers=roop.globals.providers)
+
+
+def get_session_pool(model_path):
+    with THREAD_LOCK:
+        if model_path not in SESSION_POOLS:
+            SESSION_POOLS[model_path] = SessionPool(model_path, roop.globals.session_replicas)
+        return SESSION_POOLS[model_path]
+
+
+def clear_session_pools():
+    with THREAD_LOCK:
+        SESSION_POOLS.clear()
+
+
+def fill_session_pools():
+    for session_pool in list(SESSION_POOLS.values()):
+        session_pool.fill()
+
+
+def get_session_metrics():
+    return {os.path.basename(model_path): session_pool.get_metrics() for model_path, session_pool in list(SESSION_POOLS.items())}
+
+
+def print_session_metrics():
+    for model_name, metrics in get_session_metrics().items():
+        if metrics['checkouts']:
+            print(f"Session pool {model_name}: {metrics['replicas']} replicas, {metrics['shared_checkouts']} of {metrics['checkouts']} checkouts found them all busy and shared one")
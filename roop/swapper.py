@@ -1,18 +1,24 @@
 
 import os
+import time
 from tqdm import tqdm
 import cv2
-import shutil
-import insightface
+import numpy
 import threading
-import onnxruntime
 import roop.globals
-from roop.globals import providers
-from roop.analyser import get_face_single, get_face_many
-from roop.app import SCRFD_Child, ArcFaceONNX_Child
+from roop.analyser import get_face_single, get_face_many, has_face, DetectionState, DET_REFRESH_INTERVAL
+from roop.app import SCRFD_Child, ArcFaceONNX_Child, INSwapper_Child, rank_detections
+from roop.resources import wait_for_memory
+from roop.sessions import get_session_pool
+from roop.utils import FrameWriter, read_frame
+from roop.manifest import PENDING, FILTERED, SWAPPED, SKIPPED, FAILED
 
 FACE_SWAPPER = None
+FACE_MAP = None
 THREAD_LOCK = threading.Lock()
+SIMILARITY_THRESHOLD = 0.2
+FACE_PRIORITY_METRICS = {'size': 'max', 'center': 'default'}
+SKIPPED_FACES = {'budget': 0, 'time': 0}
 
 class Facecheck:
     
@@ -20,8 +26,9 @@ class Facecheck:
         model_dir = os.path.expanduser('~/.insightface/models/buffalo_l')
         detect_model_path =  os.path.join(model_dir, 'det_10g.onnx')
         feature_model_path = os.path.join(model_dir, 'w600k_r50.onnx')
-        detect_session = onnxruntime.InferenceSession(detect_model_path, providers=providers)
-        feature_session = onnxruntime.InferenceSession(feature_model_path, providers=providers)
+        # the same pools as the analyser, no extra copy of the models
+        detect_session = get_session_pool(detect_model_path)
+        feature_session = get_session_pool(feature_model_path)
 
         self.face_detector = SCRFD_Child(detect_model_path, detect_session)
         self.face_detector.prepare(0)
@@ -30,26 +37,27 @@ class Facecheck:
         self.feature_comparator.prepare(0)
     
 
-    def get(self, swapped_face_path, framepaths, processing_paths):
+    def get(self, swapped_face_path, manifest):
         swapped_face = cv2.imread(swapped_face_path)
         swapped_face_boxes, swapped_face_keypoints = self.face_detector.autodetect(swapped_face)
         if swapped_face_boxes.shape[0] == 0:
             print("Face not found in swapped_face_image") 
         swapped_face_keypoint = swapped_face_keypoints[0]
         swapped_face_feature = self.feature_comparator.get(swapped_face, swapped_face_keypoint)
-        for frame_path in framepaths:
-            frame = cv2.imread(frame_path)
+        for frame_path in manifest.get_paths(PENDING):
+            frame = read_frame(frame_path)
             try:
                 boxes, keypoints = self.face_detector.autodetect(frame)
                 keypoint = keypoints[0]
                 face_feature = self.feature_comparator.get(frame, keypoint)
                 similarity_level = self.feature_comparator.compute_sim(swapped_face_feature, face_feature)
-                if similarity_level>=0.2:
-                    shutil.move(frame_path, processing_paths)
-                else:
-                    pass
+                manifest.set_faces(frame_path, boxes.shape[0], similarity_level)
+                if similarity_level<SIMILARITY_THRESHOLD:
+                    manifest.mark(frame_path, FILTERED)
             except:
+                manifest.mark(frame_path, FILTERED)
                 print("please select image within face")
+        manifest.set_filtered()
 
 
 
@@ -58,45 +66,165 @@ def get_face_swapper():
     with THREAD_LOCK:
         if FACE_SWAPPER is None:
             model_path = os.path.join(os.path.abspath(os.path.dirname(__file__)), '../inswapper_128.onnx')
-            FACE_SWAPPER = insightface.model_zoo.get_model(model_path, providers=roop.globals.providers)
+            FACE_SWAPPER = INSwapper_Child(model_path, get_session_pool(model_path))
     return FACE_SWAPPER
 
 
+def clear_face_swapper():
+    global FACE_SWAPPER
+    with THREAD_LOCK:
+        FACE_SWAPPER = None
+
+
+def get_face_map():
+    global FACE_MAP
+    with THREAD_LOCK:
+        if FACE_MAP is None:
+            reference_embeddings = []
+            source_faces = []
+            for reference_path, source_path in roop.globals.face_map:
+                reference_face = get_face_single(cv2.imread(reference_path))
+                source_face = get_face_single(cv2.imread(source_path))
+                if reference_face and source_face:
+                    reference_embeddings.append(reference_face.normed_embedding)
+                    source_faces.append(source_face)
+                else:
+                    print(f"No face detected in {reference_path} or {source_path}, skipping this pair")
+            FACE_MAP = numpy.array(reference_embeddings), source_faces
+    return FACE_MAP
+
+
+def get_source_face(source_img):
+    if source_img is None:
+        return None
+    return get_face_single(cv2.imread(source_img))
+
+
 def swap_face_in_frame(source_face, target_face, frame):
     if target_face:
         return get_face_swapper().get(frame, target_face, source_face, paste_back=True)
     return frame
 
 
-def process_faces(source_face, target_frame):
+def get_mapped_face_pairs(target_frame, state):
+    reference_embeddings, source_faces = get_face_map()
+    many_faces = get_face_many(target_frame, state=state)
+    face_pairs = []
+    if many_faces and source_faces:
+        # match every detected face against every reference at once
+        embeddings = numpy.array([face.normed_embedding for face in many_faces])
+        similarities = ArcFaceONNX_Child.compute_sim_many(embeddings, reference_embeddings)
+        for face, face_similarities in zip(many_faces, similarities):
+            match = face_similarities.argmax()
+            if face_similarities[match] >= SIMILARITY_THRESHOLD:
+                face.similarity = face_similarities[match]
+                face_pairs.append((source_faces[match], face))
+    return face_pairs
+
+
+def has_face_budget():
+    return bool(roop.globals.max_faces or roop.globals.face_time_budget)
+
+
+def count_skipped_faces(reason, amount):
+    with THREAD_LOCK:
+        SKIPPED_FACES[reason] += amount
+
+
+def print_skipped_faces(skipped_faces=SKIPPED_FACES):
+    if skipped_faces['budget'] or skipped_faces['time']:
+        print(f"\n\nNot swapped: {skipped_faces['budget']} faces over the face budget, {skipped_faces['time']} faces over the time budget\n\n")
+
+
+def prioritise_face_pairs(face_pairs, frame_shape):
+    if len(face_pairs) < 2 or not has_face_budget():
+        return face_pairs
+    if roop.globals.face_priority == 'identity':
+        # the faces matching a reference best, or looking most like the source face
+        similarities = [face.similarity if face.similarity is not None else numpy.dot(face.normed_embedding, source_face.normed_embedding) for source_face, face in face_pairs]
+        order = numpy.argsort(similarities)[::-1]
+    else:
+        bboxes = numpy.array([face.bbox for _, face in face_pairs])
+        order = rank_detections(bboxes, frame_shape, FACE_PRIORITY_METRICS[roop.globals.face_priority])
+    face_pairs = [face_pairs[index] for index in order]
+    if roop.globals.max_faces and len(face_pairs) > roop.globals.max_faces:
+        count_skipped_faces('budget', len(face_pairs) - roop.globals.max_faces)
+        face_pairs = face_pairs[:roop.globals.max_faces]
+    return face_pairs
+
+
+def get_face_pairs(source_face, target_frame, state=None):
+    # a frame on its own gets a fresh detection state
+    if state is None:
+        state = DetectionState()
+    if roop.globals.face_map:
+        return prioritise_face_pairs(get_mapped_face_pairs(target_frame, state), target_frame.shape)
     if roop.globals.all_faces:
-        many_faces = get_face_many(target_frame)
+        # ranking by identity needs the embeddings of the target faces
+        many_faces = get_face_many(target_frame, recognition=has_face_budget() and roop.globals.face_priority == 'identity', state=state)
         if many_faces:
-            for face in many_faces:
-                target_frame = swap_face_in_frame(source_face, face, target_frame)
+            return prioritise_face_pairs([(source_face, face) for face in many_faces], target_frame.shape)
     else:
-        face = get_face_single(target_frame)
+        face = get_face_single(target_frame, state)
         if face:
-            target_frame = swap_face_in_frame(source_face, face, target_frame)
+            return [(source_face, face)]
+    return []
+
+
+def swap_face_pairs(face_pairs, target_frame):
+    started = time.perf_counter()
+    for index, (source_face, target_face) in enumerate(face_pairs):
+        # the pairs come in priority order, at least the first face is always swapped
+        if index and roop.globals.face_time_budget and time.perf_counter() - started > roop.globals.face_time_budget / 1000:
+            count_skipped_faces('time', len(face_pairs) - index)
+            break
+        target_frame = swap_face_in_frame(source_face, target_face, target_frame)
     return target_frame
 
 
-def process_frames(source_img, frame_paths, progress=None):
-    source_face = get_face_single(cv2.imread(source_img))
-    for frame_path in frame_paths:
-        frame = cv2.imread(frame_path)
+def process_faces(source_face, target_frame, state=None):
+    return swap_face_pairs(get_face_pairs(source_face, target_frame, state), target_frame)
+
+
+def process_frames(source_img, frame_paths, progress=None, manifest=None, source_face=None, state=None):
+    if source_face is None:
+        source_face = get_source_face(source_img)
+    if state is None:
+        state = DetectionState()
+    frame_writer = FrameWriter()
+    # a frame only counts as swapped once it is on disk
+    on_written = (lambda frame_path: manifest.mark(frame_path, SWAPPED)) if manifest else None
+    # faces tend to persist, only look for the cheap way out after a frame without swaps
+    swapped = True
+    for index, frame_path in enumerate(frame_paths):
+        wait_for_memory()
+        frame = read_frame(frame_path)
         try:
-            result = process_faces(source_face, frame)
-            cv2.imwrite(frame_path, result)
+            # the prefilter can miss faces too, a regular full pass keeps a run from skipping for good
+            if swapped or not roop.globals.skip_faceless or index % DET_REFRESH_INTERVAL == 0 or has_face(frame, state):
+                result = process_faces(source_face, frame, state)
+                swapped = result is not frame
+                # untouched frames stay on disk as they are for the encoder
+                if swapped:
+                    frame_writer.write(frame_path, result, on_written)
+            if not swapped and manifest:
+                manifest.mark(frame_path, SKIPPED)
         except Exception as exception:
             print(exception)
-            pass
+            # failed frames are not pending, a finished run with a bad frame is not resumed
+            if manifest:
+                manifest.mark(frame_path, FAILED)
         if progress:
             progress.update(1)
+    frame_writer.close()
+    if manifest:
+        manifest.flush()
 
 
-def multi_process_frame(source_img, frame_paths, progress):
+def multi_process_frame(source_img, frame_paths, progress, manifest=None, source_face=None):
     threads = []
+    # the threads work on the same video and learn its face sizes together
+    state = DetectionState()
     num_threads = roop.globals.gpu_threads
     num_frames_per_thread = len(frame_paths) // num_threads
     remaining_frames = len(frame_paths) % num_threads
@@ -109,7 +237,7 @@ def multi_process_frame(source_img, frame_paths, progress):
             end_index += 1
             remaining_frames -= 1
         thread_frame_paths = frame_paths[start_index:end_index]
-        thread = threading.Thread(target=process_frames, args=(source_img, thread_frame_paths, progress))
+        thread = threading.Thread(target=process_frames, args=(source_img, thread_frame_paths, progress, manifest, source_face, state))
         threads.append(thread)
         thread.start()
         start_index = end_index
@@ -121,18 +249,24 @@ def multi_process_frame(source_img, frame_paths, progress):
 
 def process_img(source_img, target_path, output_file):
     frame = cv2.imread(target_path)
-    face = get_face_single(frame)
-    source_face = get_face_single(cv2.imread(source_img))
-    result = get_face_swapper().get(frame, face, source_face, paste_back=True)
+    if roop.globals.face_map:
+        result = process_faces(None, frame)
+    else:
+        face = get_face_single(frame, DetectionState())
+        source_face = get_source_face(source_img)
+        result = get_face_swapper().get(frame, face, source_face, paste_back=True)
     cv2.imwrite(output_file, result)
     print("\n\nImage saved as:", output_file, "\n\n")
 
 
-def process_video(source_img, frame_paths):
+def process_video(source_img, frame_paths, manifest=None):
+    skipped_before = dict(SKIPPED_FACES)
     do_multi = roop.globals.gpu_vendor is not None and roop.globals.gpu_threads > 1
     progress_bar_format = '{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}{postfix}]'
     with tqdm(total=len(frame_paths), desc="Processing", unit="frame", dynamic_ncols=True, bar_format=progress_bar_format) as progress:
         if do_multi:
-            multi_process_frame(source_img, frame_paths, progress)
+            multi_process_frame(source_img, frame_paths, progress, manifest)
         else:
-            process_frames(source_img, frame_paths, progress)
+            process_frames(source_img, frame_paths, progress, manifest)
+    # only the faces of this call, pool workers run several chunks and the parent adds them up
+    return {reason: SKIPPED_FACES[reason] - skipped_before[reason] for reason in SKIPPED_FACES}
@@ -0,0 +1,102 @@
+import os
+import json
+import time
+import platform
+import threading
+import psutil
+import roop.globals
+from roop.analyser import clear_face_analyser, DetectionState
+from roop.swapper import process_faces, get_source_face, clear_face_swapper
+from roop.sessions import clear_session_pools
+from roop.resources import get_model_paths
+from roop.utils import read_frame
+
+CACHE_PATH = os.path.expanduser('~/.roop/tuning.json')
+CALIBRATION_FRAMES = 8
+
+
+def get_cache_key(frame_shape):
+    machine = [platform.node(), platform.machine(), str(psutil.cpu_count()), str(roop.globals.gpu_vendor)] + roop.globals.providers
+    models = [os.path.basename(path) + ':' + str(os.path.getsize(path)) for path in get_model_paths() if os.path.isfile(path)]
+    resolution = f'{frame_shape[1]}x{frame_shape[0]}'
+    mode = 'face_map' if roop.globals.face_map else 'all_faces' if roop.globals.all_faces else 'single_face'
+    return '|'.join(machine + models + [resolution, mode])
+
+
+def load_cache():
+    try:
+        with open(CACHE_PATH) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cache(cache):
+    os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+    with open(CACHE_PATH, 'w') as file:
+        json.dump(cache, file, indent=2)
+
+
+def get_candidates():
+    cpu_count = psutil.cpu_count(logical=False) or psutil.cpu_count() or 1
+    if roop.globals.gpu_vendor is None:
+        # pool workers split the cores between them, each running its own onnxruntime thread pool
+        workers = [count for count in (1, 2, 4, 8, 16) if count <= min(roop.globals.cpu_cores, cpu_count)]
+        return [(count, 1, max(cpu_count // count, 1)) for count in workers]
+    threads = [count for count in (1, 2, 4, 8) if count <= roop.globals.gpu_threads]
+    return [(roop.globals.cpu_cores, count, intra_op_threads) for intra_op_threads in sorted({1, cpu_count}) for count in threads]
+
+
+def process_calibration_frames(source_face, frames):
+    state = DetectionState()
+    for frame in frames:
+        process_faces(source_face, frame.copy(), state)
+
+
+def measure_throughput(source_face, frames, num_threads):
+    # repeat the frames so every thread gets some work, results are thrown away
+    frames = frames * max(-(-num_threads * 2 // len(frames)), 1)
+    threads = [threading.Thread(target=process_calibration_frames, args=(source_face, frames[i::num_threads])) for i in range(num_threads)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return len(frames) / (time.perf_counter() - start)
+
+
+def calibrate(source_img, frame_paths):
+    frames = [read_frame(frame_path) for frame_path in frame_paths[:CALIBRATION_FRAMES]]
+    best = None
+    for cpu_cores, gpu_threads, intra_op_threads in get_candidates():
+        if roop.globals.intra_op_threads != intra_op_threads:
+            roop.globals.intra_op_threads = intra_op_threads
+            clear_face_analyser()
+            clear_face_swapper()
+            clear_session_pools()
+        source_face = get_source_face(source_img)
+        # warm up the sessions before timing them
+        process_faces(source_face, frames[0].copy())
+        fps = measure_throughput(source_face, frames, gpu_threads if roop.globals.gpu_vendor else cpu_cores)
+        print(f'Calibrating: {cpu_cores} cpu cores, {gpu_threads} gpu threads, {intra_op_threads} intra-op threads: {fps:.2f} frames/s')
+        if best is None or fps > best['fps']:
+            best = {'cpu_cores': cpu_cores, 'gpu_threads': gpu_threads, 'intra_op_threads': intra_op_threads, 'fps': fps}
+    return best
+
+
+def auto_tune(source_img, frame_paths):
+    frame_shape = read_frame(frame_paths[0]).shape
+    key = get_cache_key(frame_shape)
+    cache = load_cache()
+    if key not in cache:
+        cache[key] = calibrate(source_img, frame_paths)
+        save_cache(cache)
+    settings = cache[key]
+    roop.globals.cpu_cores = min(settings['cpu_cores'], roop.globals.cpu_cores)
+    roop.globals.gpu_threads = min(settings['gpu_threads'], roop.globals.gpu_threads)
+    roop.globals.intra_op_threads = settings['intra_op_threads']
+    # pool workers and the final run have to build their sessions with the tuned options
+    clear_face_analyser()
+    clear_face_swapper()
+    clear_session_pools()
+    print(f'Auto-tune: {roop.globals.cpu_cores} cpu cores, {roop.globals.gpu_threads} gpu threads, {roop.globals.intra_op_threads} intra-op threads')
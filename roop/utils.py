@@ -1,7 +1,17 @@
 import os
+import glob
 import shutil
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+import numpy
+import cv2
 import roop.globals
 
+JPEG_QUALITY = 95
+FRAME_WRITER_THREADS = 2
+FRAME_WRITER_PENDING = 8
+
 sep = "/"
 if os.name == "nt":
     sep = "\\"
@@ -39,14 +49,95 @@ def set_fps(input_path, output_path, fps):
     run_ffmpeg(f'-i "{input_path}" -filter:v fps=fps={fps} "{output_path}"')
 
 
+def get_ffmpeg_frame_options():
+    if roop.globals.frame_format == 'png':
+        return f'-compression_level {roop.globals.png_compression} '
+    if roop.globals.frame_format == 'jpg':
+        return '-q:v 2 '
+    return ''
+
+
 def create_video(video_name, fps, output_dir):
     output_dir = path(output_dir)
-    run_ffmpeg(f'-framerate "{fps}" -i "{output_dir}{sep}%04d.png" -c:v libx264 -crf 7 -pix_fmt yuv420p -y "{output_dir}{sep}output.mp4"')
+    output_options = f'-c:v libx264 -crf 7 -pix_fmt yuv420p -y "{output_dir}{sep}output.mp4"'
+    if roop.globals.frame_format == 'npy':
+        # ffmpeg cannot read numpy files, feed it the raw frames instead
+        frame_paths = get_frame_paths(output_dir)
+        height, width = read_frame(frame_paths[0]).shape[:2]
+        command = f'ffmpeg -hide_banner -loglevel {roop.globals.log_level} -f rawvideo -pix_fmt bgr24 -s {width}x{height} -framerate "{fps}" -i - {output_options}'
+        with subprocess.Popen(command, shell=True, stdin=subprocess.PIPE) as process:
+            for frame_path in frame_paths:
+                process.stdin.write(read_frame(frame_path).tobytes())
+            process.stdin.close()
+        return
+    run_ffmpeg(f'-framerate "{fps}" -i "{output_dir}{sep}%04d.{roop.globals.frame_format}" {output_options}')
 
 
 def extract_frames(input_path, output_dir):
     input_path, output_dir = path(input_path), path(output_dir)
-    run_ffmpeg(f'-i "{input_path}" "{output_dir}{sep}%04d.png"')
+    if roop.globals.frame_format == 'npy':
+        capture = cv2.VideoCapture(input_path)
+        frame_number = 1
+        ret, frame = capture.read()
+        while ret:
+            numpy.save(f'{output_dir}{sep}{frame_number:04d}.npy', frame)
+            frame_number += 1
+            ret, frame = capture.read()
+        capture.release()
+        return
+    run_ffmpeg(f'-i "{input_path}" {get_ffmpeg_frame_options()}"{output_dir}{sep}%04d.{roop.globals.frame_format}"')
+
+
+def get_frame_paths(directory):
+    return tuple(sorted(
+        glob.glob(os.path.join(directory, '[0-9]*.' + roop.globals.frame_format)),
+        key=lambda x: int(os.path.splitext(os.path.basename(x))[0])
+    ))
+
+
+def read_frame(frame_path):
+    if frame_path.endswith('.npy'):
+        return numpy.load(frame_path)
+    return cv2.imread(frame_path)
+
+
+def write_frame(frame_path, frame):
+    # write beside the frame and swap it in, an interrupted run never leaves a torn frame that counts as swapped,
+    # the prefix keeps the temporary file out of get_frame_paths and the extension tells cv2 the format
+    directory, name = os.path.split(frame_path)
+    temp_path = os.path.join(directory, 'tmp-' + name)
+    if frame_path.endswith('.npy'):
+        numpy.save(temp_path, frame)
+    elif frame_path.endswith('.png'):
+        cv2.imwrite(temp_path, frame, [cv2.IMWRITE_PNG_COMPRESSION, roop.globals.png_compression])
+    elif frame_path.endswith('.jpg'):
+        cv2.imwrite(temp_path, frame, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+    else:
+        cv2.imwrite(temp_path, frame)
+    os.replace(temp_path, frame_path)
+
+
+class FrameWriter:
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(FRAME_WRITER_THREADS)
+        # bound the frames waiting for the disk, so a slow disk slows the swap down instead of filling the memory
+        self.pending = threading.BoundedSemaphore(FRAME_WRITER_PENDING)
+
+    def write(self, frame_path, frame, on_written=None):
+        self.pending.acquire()
+        future = self.executor.submit(write_frame, frame_path, frame)
+        future.add_done_callback(lambda future: self.done(future, frame_path, on_written))
+
+    def done(self, future, frame_path, on_written):
+        self.pending.release()
+        if future.exception():
+            print(future.exception())
+        elif on_written:
+            on_written(frame_path)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
 
 
 def add_audio(output_dir, target_path, video, keep_frames, output_file):